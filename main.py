@@ -1,45 +1,150 @@
 from fastapi import FastAPI, UploadFile, File, Request
-from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
+from fastapi.responses import HTMLResponse, ORJSONResponse, Response, StreamingResponse
 import httpx
 import pandas as pd
+import xlsxwriter
 import os
 from io import BytesIO
 from datetime import datetime, timedelta
-import base64
 import asyncio
 import logging
-import json
 import uuid
+import hashlib
+import gzip
 import time
+import orjson
+import re
+import sqlite3
+import random
+import threading
+import itertools
+from collections import Counter
+from contextlib import asynccontextmanager
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="SonIA Tracker - BloomsPal")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """One FedEx client (token + connection pool) and tracking cache DB per worker process"""
+    app.state.fedex = FedExClient()
+    app.state.tracking_db = open_tracking_db(TRACKING_CACHE_DB)
+    yield
+    await app.state.fedex.close()
+    if app.state.tracking_db is not None:
+        with tracking_db_lock:
+            app.state.tracking_db.close()
+
+app = FastAPI(title="SonIA Tracker - BloomsPal", default_response_class=ORJSONResponse, lifespan=lifespan)
 
 # Store job progress and results
 jobs = {}
+# Finished jobs that are never downloaded (closed tab, failed job) are dropped after this many seconds
+JOB_TTL = int(os.getenv("JOB_TTL", 3600))
+# Hard cap on jobs kept in memory; the oldest finished ones make room for new uploads
+MAX_JOBS = int(os.getenv("MAX_JOBS", 64))
+
+# Cache of per-tracking FedEx results: tracking_number -> (expires_at, trackResults entry)
+tracking_cache = {}
+TRACKING_CACHE_TTL = int(os.getenv("TRACKING_CACHE_TTL", 300))  # 5 minutes for in-flight shipments
+TRACKING_CACHE_TTL_FINAL = int(os.getenv("TRACKING_CACHE_TTL_FINAL", 86400))  # 24h for terminal states
+FINAL_STATUS_CODES = {"DL", "CA", "RS"}
+# Hard cap on in-memory cache entries; expired ones are swept first, then the oldest
+TRACKING_CACHE_MAX_ENTRIES = int(os.getenv("TRACKING_CACHE_MAX_ENTRIES", 50000))
+# SQLite file backing the tracking cache across restarts; set to "" to keep it in memory only
+TRACKING_CACHE_DB = os.getenv("TRACKING_CACHE_DB", "tracking_cache.sqlite3")
+# The connection is used from worker threads (asyncio.to_thread); one statement batch at a time
+tracking_db_lock = threading.Lock()
+
+# Max FedEx batch requests in flight per worker (shared by all jobs)
+FEDEX_CONCURRENCY = int(os.getenv("FEDEX_CONCURRENCY", 5))
+fedex_semaphore = asyncio.Semaphore(FEDEX_CONCURRENCY)
+
+# Max Excel parses/builds running in worker threads at once; each holds a whole sheet in memory
+EXCEL_CONCURRENCY = int(os.getenv("EXCEL_CONCURRENCY", 2))
+excel_semaphore = asyncio.Semaphore(EXCEL_CONCURRENCY)
+# Largest upload accepted, in bytes. Requests declaring a bigger body are refused before it is
+# received (UploadSizeLimit); the exact file size is checked again before pandas touches it
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", 20 * 1024 * 1024))
+# Room for the multipart envelope (boundaries, part headers) around the file itself
+UPLOAD_OVERHEAD_BYTES = 64 * 1024
 
 FEDEX_API_KEY = os.getenv("FEDEX_API_KEY", "l7e4ca666923294740bae8dfde52ca1f52")
 FEDEX_SECRET_KEY = os.getenv("FEDEX_SECRET_KEY", "81d7f9db60554e9b97ffa7c76075763c")
 FEDEX_ACCOUNT = os.getenv("FEDEX_ACCOUNT", "740561073")
 FEDEX_BASE_URL = os.getenv("FEDEX_BASE_URL", "https://apis.fedex.com")
+# File shared by all workers (and restarts) holding the current OAuth token. Off unless set;
+# point it at a directory only this app's user can write (not a shared /tmp)
+FEDEX_TOKEN_CACHE = os.getenv("FEDEX_TOKEN_CACHE", "")
+
+# Output report columns: (result key, Excel header), in report order
+OUTPUT_COLUMNS = [
+    ("client_name", "Nombre Cliente"),
+    ("tracking_number", "FEDEX Tracking"),
+    ("sonia_status", "SonIA status"),
+    ("fedex_status", "FedEx status"),
+    ("label_creation_date", "Label Creation Date"),
+    ("ship_date", "Shipping Date"),
+    ("days_after_shipment", "Days After Shipment"),
+    ("working_days_after_shipment", "Working Days After Shipment"),
+    ("days_after_label_creation", "Days After Label Creation"),
+    ("destination_location", "Destination City/State/Country"),
+    ("history_summary", "Historial"),
+    ("sonia_recommendation", "SonIA Recomendacion"),
+]
+# Parsed-result keys after the client name, in report order
+TRACKING_RESULT_KEYS = [key for key, _ in OUTPUT_COLUMNS if key != "client_name"]
+
+# Retry backoff: base * 2^attempt plus jitter, capped
+RETRY_BASE_DELAY = 0.25
+RATE_LIMIT_BASE_DELAY = 2.0
+RETRY_MAX_DELAY = 10.0
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Circuit breaker: after this many consecutive server errors / connection failures,
+# stop calling FedEx for a cooldown and fail the remaining batches immediately
+CIRCUIT_BREAKER_THRESHOLD = 5
+CIRCUIT_BREAKER_COOLDOWN = 30.0
+
+# Constant headers for track requests; Authorization is added per call
+TRACK_HEADERS = {"Content-Type": "application/json", "X-locale": "en_US"}
+
+def backoff_delay(attempt, base=RETRY_BASE_DELAY, retry_after=None):
+    """
+    Seconds to wait before the next retry.
+    Honors the server's Retry-After header (in seconds) when present; otherwise
+    exponential backoff with random jitter so concurrent retries don't re-collide.
+    """
+    if retry_after:
+        try:
+            return min(float(retry_after), RETRY_MAX_DELAY)
+        except ValueError:
+            pass
+    delay = min(base * (2 ** attempt), RETRY_MAX_DELAY)
+    return delay + random.uniform(0, delay / 2)
 
 class FedExClient:
     def __init__(self):
         self.access_token = None
+        self.auth_header = None  # Precomputed "Bearer <token>"
         self.base_url = FEDEX_BASE_URL
         self.token_expires_at = None  # Timestamp when token expires
         self.token_buffer = 300  # Refresh 5 minutes before expiration
         self._http_client = None  # Reusable HTTP client
+        self._auth_lock = asyncio.Lock()  # Only one token refresh at a time
+        self.consecutive_failures = 0  # Server errors / connection failures in a row
+        self.circuit_open_until = 0.0  # monotonic time until which track calls are skipped
 
     async def get_http_client(self):
         """Get or create a reusable HTTP client with connection pooling"""
         if self._http_client is None or self._http_client.is_closed:
+            # HTTP/2 multiplexes concurrent batch requests over a single connection
             self._http_client = httpx.AsyncClient(
+                http2=True,
                 timeout=httpx.Timeout(30.0, connect=10.0),
-                limits=httpx.Limits(max_connections=20, max_keepalive_connections=10)
+                # Keep every pooled connection alive so bursts of batches don't re-handshake
+                limits=httpx.Limits(max_connections=32, max_keepalive_connections=32)
             )
         return self._http_client
 
@@ -49,29 +154,116 @@ class FedExClient:
             await self._http_client.aclose()
             self._http_client = None
 
+    def is_circuit_open(self):
+        """True while FedEx is considered down and track calls should be skipped"""
+        return time.monotonic() < self.circuit_open_until
+
+    def record_failure(self):
+        """Count a batch that failed on server errors / connection failures; trip the breaker at the threshold"""
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= CIRCUIT_BREAKER_THRESHOLD:
+            self.circuit_open_until = time.monotonic() + CIRCUIT_BREAKER_COOLDOWN
+            logger.error("FedEx failing repeatedly (%d in a row), pausing track calls for %.0fs",
+                         self.consecutive_failures, CIRCUIT_BREAKER_COOLDOWN)
+            self.consecutive_failures = 0
+
     def is_token_expired(self):
         """Check if token is expired or about to expire"""
         if not self.access_token or not self.token_expires_at:
             return True
         return time.time() >= (self.token_expires_at - self.token_buffer)
 
+    async def ensure_token(self, rejected_token=None):
+        """
+        Make sure a valid token is cached, refreshing it if expired or if it is the
+        token FedEx just rejected. Concurrent callers wait for a single refresh.
+        """
+        if not self.is_token_expired() and self.access_token != rejected_token:
+            return True
+        async with self._auth_lock:
+            # Another coroutine may have refreshed while we waited for the lock
+            if self.is_token_expired() or self.access_token == rejected_token:
+                # Another worker may already hold a fresh token
+                if self.load_shared_token(rejected_token):
+                    return True
+                return await self.authenticate()
+            return True
+
+    def load_shared_token(self, rejected_token=None):
+        """Adopt the token another worker (or a previous run) saved, if it is still valid"""
+        if not FEDEX_TOKEN_CACHE:
+            return False
+        try:
+            # Never follow a symlink, and only trust a file this user owns and nobody else can write
+            fd = os.open(FEDEX_TOKEN_CACHE, os.O_RDONLY | os.O_NOFOLLOW)
+            with os.fdopen(fd, "rb") as f:
+                st = os.fstat(f.fileno())
+                if st.st_uid != os.geteuid() or st.st_mode & 0o022:
+                    logger.warning("Ignoring shared FedEx token %s: not owned by this user or writable by others", FEDEX_TOKEN_CACHE)
+                    return False
+                cached = orjson.loads(f.read())
+        except (OSError, orjson.JSONDecodeError):
+            return False
+        # Anything but a well-formed token record counts as no shared token
+        if not isinstance(cached, dict):
+            return False
+        expires_at = cached.get("expires_at")
+        if (not isinstance(cached.get("access_token"), str) or not cached["access_token"]
+                or not isinstance(expires_at, (int, float)) or isinstance(expires_at, bool)):
+            return False
+        if (cached.get("client_id") != FEDEX_API_KEY or cached.get("base_url") != self.base_url
+                or cached.get("access_token") == rejected_token):
+            return False
+        if time.time() >= expires_at - self.token_buffer:
+            return False
+        self.access_token = cached["access_token"]
+        self.auth_header = f"Bearer {self.access_token}"
+        self.token_expires_at = expires_at
+        logger.info("Using shared FedEx token, expires in %d seconds", self.token_expires_at - time.time())
+        return True
+
+    def save_shared_token(self):
+        """Write the current token for other workers; atomic replace, readable only by this user"""
+        if not FEDEX_TOKEN_CACHE:
+            return
+        # Unique name, created exclusively: a planted file or symlink makes the open fail
+        tmp_path = f"{FEDEX_TOKEN_CACHE}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600)
+            with os.fdopen(fd, "wb") as f:
+                f.write(orjson.dumps({
+                    "client_id": FEDEX_API_KEY,
+                    "base_url": self.base_url,
+                    "access_token": self.access_token,
+                    "expires_at": self.token_expires_at,
+                }))
+            os.replace(tmp_path, FEDEX_TOKEN_CACHE)
+        except OSError as e:
+            logger.warning("Could not save shared FedEx token: %s", e)
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+
     async def authenticate(self):
         url = f"{self.base_url}/oauth/token"
         headers = {"Content-Type": "application/x-www-form-urlencoded"}
         data = {"grant_type": "client_credentials", "client_id": FEDEX_API_KEY, "client_secret": FEDEX_SECRET_KEY}
-        logger.info(f"Authenticating with FedEx at {url}")
+        logger.debug("Authenticating with FedEx at %s", url)
         client = await self.get_http_client()
         response = await client.post(url, headers=headers, data=data)
-        logger.info(f"Auth response status: {response.status_code}")
+        logger.debug("Auth response status: %s", response.status_code)
         if response.status_code == 200:
-            token_data = response.json()
+            token_data = orjson.loads(response.content)
             self.access_token = token_data.get("access_token")
+            self.auth_header = f"Bearer {self.access_token}"
             expires_in = token_data.get("expires_in", 3600)  # Default 1 hour
             self.token_expires_at = time.time() + expires_in
-            logger.info(f"Authentication successful, token expires in {expires_in} seconds")
+            self.save_shared_token()
+            logger.info("Authentication successful over %s, token expires in %s seconds", response.http_version, expires_in)
             return True
         else:
-            logger.error(f"Auth failed: {response.text}")
+            logger.error("Auth failed: %s", response.text)
             return False
 
     async def track_shipments_batch(self, tracking_numbers, max_retries=3):
@@ -79,59 +271,148 @@ class FedExClient:
         Track multiple shipments in a single API call (up to 30 per FedEx recommendation).
         Returns a dict mapping tracking_number -> response data.
         """
-        if self.is_token_expired():
-            logger.info("Token expired or about to expire, refreshing...")
-            await self.authenticate()
+        try:
+            await self.ensure_token()
+        except httpx.TransportError as e:
+            # Same as a batch that failed on connection errors: counted once, no data
+            logger.error("Could not refresh FedEx token (%s), skipping batch of %d", e, len(tracking_numbers))
+            self.record_failure()
+            return None
+        if not self.auth_header:
+            logger.error("No FedEx access token available, skipping batch of %d", len(tracking_numbers))
+            return None
 
         url = f"{self.base_url}/track/v1/trackingnumbers"
-        headers = {"Authorization": f"Bearer {self.access_token}", "Content-Type": "application/json", "X-locale": "en_US"}
-        payload = {
+        headers = {**TRACK_HEADERS, "Authorization": self.auth_header}
+        token_used = self.access_token
+        # Serialize once per batch; retries reuse the same body
+        body = orjson.dumps({
             "includeDetailedScans": True,
             "trackingInfo": [
                 {"trackingNumberInfo": {"trackingNumber": tn}} for tn in tracking_numbers
             ]
-        }
-
-        client = await self.get_http_client()
+        })
 
+        # Whether the latest attempt hit a 5xx / connection error; the breaker counts
+        # the batch's final outcome once, not every retry
+        server_failure = False
         for attempt in range(max_retries):
+            if self.is_circuit_open():
+                logger.warning("FedEx circuit open, skipping batch of %d", len(tracking_numbers))
+                return None
+            is_last_attempt = attempt == max_retries - 1
             try:
-                response = await client.post(url, headers=headers, json=payload)
+                client = await self.get_http_client()
+                response = await client.post(url, headers=headers, content=body)
 
                 if response.status_code == 401:
                     logger.warning("Got 401, refreshing token and retrying...")
-                    await self.authenticate()
-                    headers["Authorization"] = f"Bearer {self.access_token}"
+                    await self.ensure_token(rejected_token=token_used)
+                    token_used = self.access_token
+                    headers["Authorization"] = self.auth_header
                     continue
 
-                if response.status_code == 429:
-                    wait_time = (2 ** attempt) + 2  # 3s, 4s, 6s
-                    logger.warning(f"Rate limited on batch, waiting {wait_time}s (attempt {attempt + 1}/{max_retries})...")
-                    await asyncio.sleep(wait_time)
-                    continue
-
-                if response.status_code >= 500:
-                    wait_time = (2 ** attempt) + 1
-                    logger.warning(f"Server error {response.status_code}, retrying in {wait_time}s...")
+                server_failure = response.status_code >= 500
+                if not server_failure:
+                    self.consecutive_failures = 0
+
+                if response.status_code in RETRY_STATUS_CODES:
+                    if is_last_attempt:
+                        break
+                    if response.status_code == 429:
+                        wait_time = backoff_delay(attempt, RATE_LIMIT_BASE_DELAY, response.headers.get("Retry-After"))
+                        logger.warning("Rate limited on batch, waiting %.2fs (attempt %d/%d)...", wait_time, attempt + 1, max_retries)
+                    else:
+                        wait_time = backoff_delay(attempt)
+                        logger.warning("Server error %s, retrying in %.2fs...", response.status_code, wait_time)
                     await asyncio.sleep(wait_time)
                     continue
 
                 if response.status_code == 200:
-                    return response.json()
+                    # Batch responses carry detailed scans for up to 30 shipments
+                    return orjson.loads(response.content)
                 else:
-                    logger.error(f"Batch track failed: {response.status_code} {response.text[:300]}")
+                    logger.error("Batch track failed: %s %.300s", response.status_code, response.text)
                     return None
 
-            except (httpx.ConnectError, httpx.ReadTimeout, httpx.WriteTimeout, httpx.PoolTimeout) as e:
-                wait_time = (2 ** attempt) + 1
-                logger.warning(f"Connection error on batch: {e}. Retrying in {wait_time}s (attempt {attempt + 1}/{max_retries})...")
+            except httpx.TransportError as e:
+                server_failure = True
+                # No close() here: the client is shared by every in-flight batch, and
+                # httpx already drops the broken connection from its pool
+                if is_last_attempt:
+                    logger.warning("Connection error on batch: %s (attempt %d/%d)", e, attempt + 1, max_retries)
+                    break
+                wait_time = backoff_delay(attempt)
+                logger.warning("Connection error on batch: %s. Retrying in %.2fs (attempt %d/%d)...", e, wait_time, attempt + 1, max_retries)
                 await asyncio.sleep(wait_time)
-                if attempt >= 1:
-                    await self.close()
 
-        logger.error(f"All {max_retries} retries exhausted for batch of {len(tracking_numbers)}")
+        logger.error("All %d retries exhausted for batch of %d", max_retries, len(tracking_numbers))
+        if server_failure:
+            self.record_failure()
         return None
 
+# Description phrases per SonIA status, in priority order: when a description
+# contains phrases of several statuses, the first status listed wins.
+# "Shipment information sent to FedEx" ALWAYS means Label Created.
+DESCRIPTION_STATUS_PHRASES = [
+    ("Label Created", ["shipment information sent", "label created", "shipping label"]),
+    ("Delivered", ["delivered"]),
+    ("Out for Delivery", ["out for delivery", "on fedex vehicle for delivery"]),
+    ("Picked Up", ["picked up", "package received"]),
+    ("In Transit", ["in transit", "departed", "arrived", "left fedex", "at fedex", "on the way",
+                    "at destination sort", "at local fedex", "in fedex", "international shipment release"]),
+    ("In Customs", ["clearance", "customs", "import", "broker"]),
+    ("Exception", ["exception"]),
+    ("Delayed", ["delay"]),
+    ("On Hold", ["hold"]),
+    ("Delivery Attempted", ["delivery attempt", "unable to deliver"]),
+    ("Returned to Sender", ["return"]),
+]
+DESCRIPTION_PHRASE_RANK = {
+    phrase: rank
+    for rank, (_, phrases) in enumerate(DESCRIPTION_STATUS_PHRASES)
+    for phrase in phrases
+}
+# Zero-width lookahead finds every (possibly overlapping) phrase in one scan;
+# alternatives are ordered by priority so the best phrase wins at each position
+DESCRIPTION_STATUS_RE = re.compile(
+    "(?=(" + "|".join(re.escape(phrase) for phrase in DESCRIPTION_PHRASE_RANK) + "))"
+)
+
+def match_description_status(desc_lower):
+    """Return the highest-priority SonIA status whose phrase appears in desc_lower, or None"""
+    best_rank = None
+    for match in DESCRIPTION_STATUS_RE.finditer(desc_lower):
+        rank = DESCRIPTION_PHRASE_RANK[match.group(1)]
+        if best_rank is None or rank < best_rank:
+            best_rank = rank
+            if rank == 0:
+                break
+    return DESCRIPTION_STATUS_PHRASES[best_rank][0] if best_rank is not None else None
+
+# FedEx status code -> SonIA status, used when the description matches no phrase
+STATUS_CODE_MAPPING = {
+    "DL": "Delivered",
+    "OD": "Out for Delivery",
+    "PU": "Picked Up",
+    "IT": "In Transit",
+    "AA": "In Transit",
+    "AR": "In Transit",
+    "DP": "In Transit",
+    "AF": "In Transit",
+    "PM": "In Transit",
+    "DE": "Exception",
+    "SE": "Exception",
+    "OC": "Exception",
+    "HL": "On Hold",
+    "RS": "Returned to Sender",
+    "CA": "Cancelled",
+    "CD": "In Customs",
+    "IN": "Label Created",
+    "SP": "Label Created",
+    "PL": "Label Created"
+}
+
 def get_short_status(status_code, description):
     """
     Convert FedEx status to normalized SonIA status.
@@ -139,95 +420,61 @@ def get_short_status(status_code, description):
     """
     desc_lower = description.lower() if description else ""
 
-    # PRIORITY 1: Check description first for specific phrases
-    # "Shipment information sent to FedEx" ALWAYS means Label Created
-    if "shipment information sent" in desc_lower:
-        return "Label Created"
-    if "label created" in desc_lower or "shipping label" in desc_lower:
-        return "Label Created"
-
-    # Delivered
-    if "delivered" in desc_lower:
-        return "Delivered"
-
-    # Out for Delivery
-    if "out for delivery" in desc_lower or "on fedex vehicle for delivery" in desc_lower:
-        return "Out for Delivery"
-
-    # Picked Up
-    if "picked up" in desc_lower or "package received" in desc_lower:
-        return "Picked Up"
-
-    # In Transit variations
-    if any(x in desc_lower for x in ["in transit", "departed", "arrived", "left fedex",
-                                      "at fedex", "on the way", "at destination sort",
-                                      "at local fedex", "in fedex", "international shipment release"]):
-        return "In Transit"
-
-    # Clearance/Customs
-    if any(x in desc_lower for x in ["clearance", "customs", "import", "broker"]):
-        return "In Customs"
-
-    # Exception
-    if "exception" in desc_lower:
-        return "Exception"
-
-    # Delay
-    if "delay" in desc_lower:
-        return "Delayed"
-
-    # Hold
-    if "hold" in desc_lower:
-        return "On Hold"
-
-    # Delivery Attempted
-    if "delivery attempt" in desc_lower or "unable to deliver" in desc_lower:
-        return "Delivery Attempted"
-
-    # Return
-    if "return" in desc_lower:
-        return "Returned to Sender"
+    # PRIORITY 1: Check description first for specific phrases (single regex pass)
+    status = match_description_status(desc_lower)
+    if status:
+        return status
 
     # PRIORITY 2: If no description match, check status code
-    status_mapping = {
-        "DL": "Delivered",
-        "OD": "Out for Delivery",
-        "PU": "Picked Up",
-        "IT": "In Transit",
-        "AA": "In Transit",
-        "AR": "In Transit",
-        "DP": "In Transit",
-        "AF": "In Transit",
-        "PM": "In Transit",
-        "DE": "Exception",
-        "SE": "Exception",
-        "OC": "Exception",
-        "HL": "On Hold",
-        "RS": "Returned to Sender",
-        "CA": "Cancelled",
-        "CD": "In Customs",
-        "IN": "Label Created",
-        "SP": "Label Created",
-        "PL": "Label Created"
-    }
-
     if status_code:
         code_upper = status_code.upper()
-        if code_upper in status_mapping:
-            return status_mapping[code_upper]
+        if code_upper in STATUS_CODE_MAPPING:
+            return STATUS_CODE_MAPPING[code_upper]
 
     return description[:30] if description else "Unknown"
 
+def parse_ymd(date_str):
+    """Parse a 'YYYY-MM-DD' string (FedEx dates sliced to 10 chars) without strptime's format machinery"""
+    if len(date_str) != 10 or date_str[4] != "-" or date_str[7] != "-":
+        raise ValueError(f"Invalid date: {date_str!r}")
+    return datetime(int(date_str[0:4]), int(date_str[5:7]), int(date_str[8:10]))
+
+def parse_report_date(date_str, label):
+    """parse_ymd for report fields: None when the date is missing or invalid (logged)"""
+    if not date_str:
+        return None
+    try:
+        return parse_ymd(date_str)
+    except ValueError as e:
+        logger.error("Error parsing %s date: %s", label, e)
+        return None
+
 def calculate_working_days(start_date, end_date):
-    working_days = 0
-    current = start_date
-    while current < end_date:
-        if current.weekday() < 5:
-            working_days += 1
-        current += timedelta(days=1)
-    return working_days
-
-def generate_sonia_analysis(track_data, status, is_delivered, delivery_date, ship_date, label_date):
+    """
+    Count Mon-Fri days stepping one day at a time from start_date while < end_date.
+    Closed form: whole weeks contribute 5 each, plus the weekdays in the leftover days.
+    """
+    delta = end_date - start_date
+    if delta <= timedelta(0):
+        return 0
+    # Number of steps start, start+1d, ... that stay strictly before end_date
+    days = delta.days + (1 if delta.seconds or delta.microseconds else 0)
+    full_weeks, extra_days = divmod(days, 7)
+    start_weekday = start_date.weekday()
+    return full_weeks * 5 + sum(1 for i in range(extra_days) if (start_weekday + i) % 7 < 5)
+
+# Fixed recommendations for statuses that don't depend on dates.
+# `status` is always a get_short_status() value, so exact lookups are enough.
+STATUS_RECOMMENDATIONS = {
+    "Out for Delivery": "Paquete en camino para entrega hoy!",
+    "Exception": "ACCION REQUERIDA: Paquete tiene una excepcion. Contactar FedEx.",
+    "On Hold": "ACCION REQUERIDA: Paquete tiene una excepcion. Contactar FedEx.",
+    "In Customs": "Paquete en proceso de aduana. Puede tomar varios dias.",
+    "Delayed": "ATENCION: Paquete retrasado. Monitorear de cerca.",
+}
+
+def generate_sonia_analysis(track_data, status, is_delivered, delivery_dt, ship_dt, label_dt, today):
+    """Dates arrive already parsed (None when missing or invalid)"""
     scan_events = track_data.get("scanEvents", [])
     history_parts = []
     for event in scan_events[:5]:
@@ -242,191 +489,163 @@ def generate_sonia_analysis(track_data, status, is_delivered, delivery_date, shi
     history_summary = " -> ".join(history_parts) if history_parts else "No scan history available"
 
     recommendation = ""
-    today = datetime.now()
 
     if is_delivered:
-        if delivery_date and ship_date:
-            try:
-                delivery_dt = datetime.strptime(delivery_date, "%Y-%m-%d")
-                ship_dt = datetime.strptime(ship_date, "%Y-%m-%d")
-                transit_days = (delivery_dt - ship_dt).days
-                if transit_days <= 2:
-                    recommendation = "Excelente tiempo de entrega! Paquete llego rapido."
-                elif transit_days <= 5:
-                    recommendation = "Buen tiempo de entrega dentro de lo esperado."
-                else:
-                    recommendation = "Entrega tomo mas tiempo de lo usual."
-            except:
-                recommendation = "Paquete entregado exitosamente."
+        if delivery_dt and ship_dt:
+            transit_days = (delivery_dt - ship_dt).days
+            if transit_days <= 2:
+                recommendation = "Excelente tiempo de entrega! Paquete llego rapido."
+            elif transit_days <= 5:
+                recommendation = "Buen tiempo de entrega dentro de lo esperado."
+            else:
+                recommendation = "Entrega tomo mas tiempo de lo usual."
         else:
             recommendation = "Paquete entregado exitosamente."
-    elif "label created" in status.lower():
-        if label_date:
-            try:
-                label_dt = datetime.strptime(label_date, "%Y-%m-%d")
-                days_since_label = (today - label_dt).days
-                if days_since_label > 5:
-                    recommendation = f"ATENCION: {days_since_label} dias desde que se creo la etiqueta. Contactar al remitente."
-                elif days_since_label > 2:
-                    recommendation = "Etiqueta creada pero aun no recogida. Verificar con remitente."
-                else:
-                    recommendation = "Recien creada. Esperando recogida de FedEx."
-            except:
-                recommendation = "Esperando recogida de FedEx."
+    elif status == "Label Created":
+        if label_dt:
+            days_since_label = (today - label_dt).days
+            if days_since_label > 5:
+                recommendation = f"ATENCION: {days_since_label} dias desde que se creo la etiqueta. Contactar al remitente."
+            elif days_since_label > 2:
+                recommendation = "Etiqueta creada pero aun no recogida. Verificar con remitente."
+            else:
+                recommendation = "Recien creada. Esperando recogida de FedEx."
         else:
             recommendation = "Esperando recogida de FedEx."
-    elif "in transit" in status.lower():
-        if ship_date:
-            try:
-                ship_dt = datetime.strptime(ship_date, "%Y-%m-%d")
-                days_in_transit = (today - ship_dt).days
-                if days_in_transit > 7:
-                    recommendation = f"ATENCION: {days_in_transit} dias en transito. Verificar retrasos."
-                elif days_in_transit > 4:
-                    recommendation = "Tiempo de transito extendido. Posible retraso en aduana."
-                else:
-                    recommendation = "Paquete moviendose normalmente en red FedEx."
-            except:
-                recommendation = "Paquete en transito al destino."
+    elif status == "In Transit":
+        if ship_dt:
+            days_in_transit = (today - ship_dt).days
+            if days_in_transit > 7:
+                recommendation = f"ATENCION: {days_in_transit} dias en transito. Verificar retrasos."
+            elif days_in_transit > 4:
+                recommendation = "Tiempo de transito extendido. Posible retraso en aduana."
+            else:
+                recommendation = "Paquete moviendose normalmente en red FedEx."
         else:
             recommendation = "Paquete en transito al destino."
-    elif "out for delivery" in status.lower():
-        recommendation = "Paquete en camino para entrega hoy!"
-    elif "exception" in status.lower() or "hold" in status.lower():
-        recommendation = "ACCION REQUERIDA: Paquete tiene una excepcion. Contactar FedEx."
-    elif "customs" in status.lower() or "clearance" in status.lower():
-        recommendation = "Paquete en proceso de aduana. Puede tomar varios dias."
-    elif "delayed" in status.lower():
-        recommendation = "ATENCION: Paquete retrasado. Monitorear de cerca."
     else:
-        recommendation = "Monitorear envio para actualizaciones."
+        recommendation = STATUS_RECOMMENDATIONS.get(status, "Monitorear envio para actualizaciones.")
 
     return history_summary, recommendation
 
-def parse_tracking_response(response, tracking_number):
-    result = {
-        "tracking_number": tracking_number,
-        "sonia_status": "Unknown",
-        "fedex_status": "",
-        "history_summary": "",
-        "sonia_recommendation": "",
-        "label_creation_date": "",
-        "ship_date": "",
-        "delivery_date": "",
-        "days_after_shipment": 0,
-        "working_days_after_shipment": 0,
-        "days_after_label_creation": 0,
-        "destination_location": "",
-        "is_delivered": False
-    }
+# Row defaults; also the whole row when FedEx returned nothing for a tracking number
+EMPTY_TRACKING_RESULT = {
+    "tracking_number": "",
+    "sonia_status": "Unknown",
+    "fedex_status": "",
+    "history_summary": "",
+    "sonia_recommendation": "",
+    "label_creation_date": "",
+    "ship_date": "",
+    "delivery_date": "",
+    "days_after_shipment": 0,
+    "working_days_after_shipment": 0,
+    "days_after_label_creation": 0,
+    "destination_location": "",
+    "is_delivered": False
+}
+
+def parse_tracking_response(track_data, tracking_number, today):
+    """
+    Parse one FedEx trackResults entry (None when FedEx returned nothing) into a report row.
+    today is the job's reference time for the day counts, taken once per job.
+    """
+    result = {**EMPTY_TRACKING_RESULT, "tracking_number": tracking_number}
+    if not track_data:
+        return result
 
     try:
-        if response and "output" in response:
-            complete_track = response["output"].get("completeTrackResults", [])
-            if complete_track:
-                track_result = complete_track[0].get("trackResults", [])
-                if track_result:
-                    track_data = track_result[0]
-                    latest_status = track_data.get("latestStatusDetail", {})
-                    status_code = latest_status.get("code", "")
-                    status_desc = latest_status.get("description", "")
-
-                    # SonIA status = normalized value (check description FIRST)
-                    result["sonia_status"] = get_short_status(status_code, status_desc)
-                    # FedEx status = original description from API
-                    result["fedex_status"] = status_desc if status_desc else status_code
-                    result["is_delivered"] = "delivered" in result["sonia_status"].lower()
-
-                    # Get dates from dateAndTimes
-                    date_times = track_data.get("dateAndTimes", [])
-                    for dt in date_times:
-                        dt_type = dt.get("type", "")
-                        dt_value = dt.get("dateTime", "")
-                        if dt_value:
-                            date_only = dt_value[:10]
-                            if dt_type == "ACTUAL_PICKUP" or dt_type == "SHIP":
-                                result["ship_date"] = date_only
-                            elif dt_type == "ACTUAL_DELIVERY":
-                                result["delivery_date"] = date_only
-                                result["is_delivered"] = True
-
-                    # Get Label Creation Date from scan events
-                    # Look for "Shipment information sent to FedEx" event
-                    scan_events = track_data.get("scanEvents", [])
-                    for event in reversed(scan_events):  # Start from oldest event
-                        event_desc = event.get("eventDescription", "").lower()
-                        event_date = event.get("date", "")
-                        if event_date and ("shipment information sent" in event_desc or
-                                          "label created" in event_desc or
-                                          "shipping label" in event_desc):
-                            result["label_creation_date"] = event_date[:10]
-                            break
-
-                    # Get Ship Date (Picked Up) from scan events if not found
-                    if not result["ship_date"]:
-                        for event in reversed(scan_events):
-                            event_desc = event.get("eventDescription", "").lower()
-                            event_date = event.get("date", "")
-                            if event_date and ("picked up" in event_desc or "package received" in event_desc):
-                                result["ship_date"] = event_date[:10]
-                                break
-
-                    # Destination
-                    dest = track_data.get("recipientInformation", {}).get("address", {})
-                    if not dest:
-                        dest = track_data.get("destinationLocation", {}).get("locationContactAndAddress", {}).get("address", {})
-                    if dest:
-                        city = dest.get("city", "")
-                        state = dest.get("stateOrProvinceCode", "")
-                        country = dest.get("countryCode", "")
-                        parts = [p for p in [city, state, country] if p]
-                        result["destination_location"] = ", ".join(parts)
-
-                    # Calculate days
-                    today = datetime.now()
-
-                    if result["ship_date"]:
-                        try:
-                            ship_dt = datetime.strptime(result["ship_date"], "%Y-%m-%d")
-                            if result["is_delivered"] and result["delivery_date"]:
-                                delivery_dt = datetime.strptime(result["delivery_date"], "%Y-%m-%d")
-                                days_to_deliver = (delivery_dt - ship_dt).days
-                                working_days_to_deliver = calculate_working_days(ship_dt, delivery_dt)
-                                result["days_after_shipment"] = f"ENTREGADO EN {days_to_deliver} DIAS"
-                                result["working_days_after_shipment"] = f"ENTREGADO EN {working_days_to_deliver} DIAS HABILES"
-                            else:
-                                result["days_after_shipment"] = (today - ship_dt).days
-                                result["working_days_after_shipment"] = calculate_working_days(ship_dt, today)
-                        except Exception as e:
-                            logger.error(f"Error calculating ship days: {e}")
-
-                    if result["label_creation_date"]:
-                        try:
-                            label_dt = datetime.strptime(result["label_creation_date"], "%Y-%m-%d")
-                            if result["is_delivered"] and result["delivery_date"]:
-                                delivery_dt = datetime.strptime(result["delivery_date"], "%Y-%m-%d")
-                                result["days_after_label_creation"] = f"ENTREGADO EN {(delivery_dt - label_dt).days} DIAS"
-                            else:
-                                result["days_after_label_creation"] = (today - label_dt).days
-                        except Exception as e:
-                            logger.error(f"Error calculating label days: {e}")
-
-                    history, recommendation = generate_sonia_analysis(
-                        track_data, result["sonia_status"], result["is_delivered"],
-                        result["delivery_date"], result["ship_date"], result["label_creation_date"]
-                    )
-                    result["history_summary"] = history
-                    result["sonia_recommendation"] = recommendation
+        latest_status = track_data.get("latestStatusDetail", {})
+        status_code = latest_status.get("code", "")
+        status_desc = latest_status.get("description", "")
+
+        # SonIA status = normalized value (check description FIRST)
+        result["sonia_status"] = get_short_status(status_code, status_desc)
+        # FedEx status = original description from API
+        result["fedex_status"] = status_desc if status_desc else status_code
+        result["is_delivered"] = "delivered" in result["sonia_status"].lower()
+
+        # Get dates from dateAndTimes (one pass into type -> dateTime)
+        date_by_type = {
+            dt.get("type", ""): dt["dateTime"]
+            for dt in track_data.get("dateAndTimes", [])
+            if dt.get("dateTime")
+        }
+        # Actual pickup is the real ship date; SHIP is only the planned one
+        ship_dt_value = date_by_type.get("ACTUAL_PICKUP") or date_by_type.get("SHIP")
+        if ship_dt_value:
+            result["ship_date"] = ship_dt_value[:10]
+        delivery_dt_value = date_by_type.get("ACTUAL_DELIVERY")
+        if delivery_dt_value:
+            result["delivery_date"] = delivery_dt_value[:10]
+            result["is_delivered"] = True
+
+        # One pass over scan events, oldest first: Label Creation Date from the first
+        # "Shipment information sent to FedEx" event and, if dateAndTimes had no
+        # ship date, Ship Date from the first "Picked Up" event
+        need_ship_date = not result["ship_date"]
+        for event in reversed(track_data.get("scanEvents", [])):
+            event_date = event.get("date", "")
+            if not event_date:
+                continue
+            event_desc = event.get("eventDescription", "").lower()
+            if not result["label_creation_date"] and ("shipment information sent" in event_desc or
+                                                      "label created" in event_desc or
+                                                      "shipping label" in event_desc):
+                result["label_creation_date"] = event_date[:10]
+            if need_ship_date and ("picked up" in event_desc or "package received" in event_desc):
+                result["ship_date"] = event_date[:10]
+                need_ship_date = False
+            if result["label_creation_date"] and not need_ship_date:
+                break
+
+        # Destination
+        dest = (
+            track_data.get("recipientInformation", {}).get("address")
+            or track_data.get("destinationLocation", {}).get("locationContactAndAddress", {}).get("address")
+        )
+        if dest:
+            result["destination_location"] = ", ".join(
+                filter(None, (dest.get("city", ""), dest.get("stateOrProvinceCode", ""), dest.get("countryCode", "")))
+            )
+
+        # Parse each date once; the day counts and the analysis share them
+        is_delivered = result["is_delivered"]
+        ship_dt = parse_report_date(result["ship_date"], "ship")
+        label_dt = parse_report_date(result["label_creation_date"], "label")
+        delivery_dt = parse_report_date(result["delivery_date"], "delivery") if is_delivered else None
+        delivered_on = is_delivered and result["delivery_date"]
+
+        if ship_dt:
+            if not delivered_on:
+                result["days_after_shipment"] = (today - ship_dt).days
+                result["working_days_after_shipment"] = calculate_working_days(ship_dt, today)
+            elif delivery_dt:
+                days_to_deliver = (delivery_dt - ship_dt).days
+                working_days_to_deliver = calculate_working_days(ship_dt, delivery_dt)
+                result["days_after_shipment"] = f"ENTREGADO EN {days_to_deliver} DIAS"
+                result["working_days_after_shipment"] = f"ENTREGADO EN {working_days_to_deliver} DIAS HABILES"
+
+        if label_dt:
+            if not delivered_on:
+                result["days_after_label_creation"] = (today - label_dt).days
+            elif delivery_dt:
+                result["days_after_label_creation"] = f"ENTREGADO EN {(delivery_dt - label_dt).days} DIAS"
+
+        history, recommendation = generate_sonia_analysis(
+            track_data, result["sonia_status"], is_delivered, delivery_dt, ship_dt, label_dt, today
+        )
+        result["history_summary"] = history
+        result["sonia_recommendation"] = recommendation
 
     except Exception as e:
-        logger.error(f"Error parsing response: {e}")
+        logger.error("Error parsing response: %s", e)
         result["sonia_recommendation"] = f"Error procesando datos: {str(e)}"
 
     return result
 
-@app.get("/", response_class=HTMLResponse)
-async def home():
-    return """
+# Landing page, built once at import instead of inside the request handler
+HOME_HTML = """
 <!DOCTYPE html>
 <html lang="es">
 <head>
@@ -867,46 +1086,60 @@ async def home():
                 var totalGuias = startData.total;
                 progressLabel.textContent = 'Procesando ' + totalGuias + ' guías...';
 
-                var completed = false;
-                while (!completed) {
-                    await new Promise(r => setTimeout(r, 500));
-
-                    var progressResponse = await fetch('/progress/' + jobId);
-                    var progressData = await progressResponse.json();
-
-                    var percent = progressData.percent || 0;
-                    var current = progressData.current || 0;
-                    var total = progressData.total || totalGuias;
-
-                    progressBar.style.width = percent + '%';
-                    progressPercent.textContent = percent + '%';
-                    progressDetails.textContent = 'Guía ' + current + ' de ' + total;
-
-                    if (progressData.status === 'completed') {
-                        completed = true;
-                        progressBar.style.width = '100%';
-                        progressPercent.textContent = '100%';
-                        progressDetails.textContent = 'Generando reporte...';
-
-                        var resultResponse = await fetch('/result/' + jobId);
-                        var resultData = await resultResponse.json();
-
-                        if (resultData.success) {
-                            var link = document.createElement('a');
-                            link.href = 'data:application/vnd.openxmlformats-officedocument.spreadsheetml.sheet;base64,' + resultData.file;
-                            link.download = 'SonIA_Tracking_Results.xlsx';
-                            link.click();
-
-                            result.classList.add('visible', 'success');
-                            result.classList.remove('error');
-                            resultIcon.textContent = '✅';
-                            resultText.textContent = 'SonIA procesó ' + total + ' guías exitosamente!';
-                        } else {
-                            throw new Error(resultData.error);
+                // El servidor empuja el progreso por SSE solo cuando cambia
+                var progressData = await new Promise(function(resolve, reject) {
+                    var source = new EventSource('/progress-stream/' + jobId);
+                    source.onmessage = function(event) {
+                        var data = JSON.parse(event.data);
+                        var percent = data.percent || 0;
+                        progressBar.style.width = percent + '%';
+                        progressPercent.textContent = percent + '%';
+                        progressDetails.textContent = 'Guía ' + (data.current || 0) + ' de ' + (data.total || totalGuias);
+
+                        if (data.status !== 'processing') {
+                            source.close();
+                            resolve(data);
                         }
-                    } else if (progressData.status === 'error') {
-                        throw new Error(progressData.error || 'Error procesando archivo');
+                    };
+                    source.onerror = function() {
+                        // EventSource reintenta solo; si se rindió, no hay más progreso
+                        if (source.readyState === EventSource.CLOSED) {
+                            reject(new Error('Se perdió la conexión con el servidor'));
+                        }
+                    };
+                });
+
+                if (progressData.status !== 'completed') {
+                    throw new Error(progressData.error || 'Error procesando archivo');
+                }
+
+                var total = progressData.total || totalGuias;
+                progressBar.style.width = '100%';
+                progressPercent.textContent = '100%';
+                progressDetails.textContent = 'Descargando reporte...';
+
+                var resultResponse = await fetch(progressData.download_url);
+
+                if (resultResponse.ok) {
+                    var fileBlob = await resultResponse.blob();
+                    var link = document.createElement('a');
+                    link.href = URL.createObjectURL(fileBlob);
+                    link.download = 'SonIA_Tracking_Results.xlsx';
+                    link.click();
+                    setTimeout(function() { URL.revokeObjectURL(link.href); }, 1000);
+
+                    result.classList.add('visible', 'success');
+                    result.classList.remove('error');
+                    resultIcon.textContent = '✅';
+                    if (progressData.warning) {
+                        resultIcon.textContent = '⚠️';
+                        resultText.textContent = 'SonIA procesó ' + total + ' guías. ' + progressData.warning;
+                    } else {
+                        resultText.textContent = 'SonIA procesó ' + total + ' guías exitosamente!';
                     }
+                } else {
+                    var errorData = await resultResponse.json();
+                    throw new Error(errorData.error);
                 }
             } catch (error) {
                 result.classList.add('visible', 'error');
@@ -925,29 +1158,133 @@ async def home():
 </body>
 </html>
 """
+# Encoded and gzipped once; the ETag lets browsers revalidate with a bodyless 304
+HOME_HTML_BYTES = HOME_HTML.encode("utf-8")
+HOME_HTML_GZIP = gzip.compress(HOME_HTML_BYTES, mtime=0)
+HOME_ETAG = hashlib.sha1(HOME_HTML_BYTES).hexdigest()
+HOME_HEADERS = {
+    "ETag": f'"{HOME_ETAG}"',
+    "Cache-Control": "no-cache",
+    "Vary": "Accept-Encoding",
+}
+HOME_GZIP_HEADERS = {**HOME_HEADERS, "ETag": f'"{HOME_ETAG}-gzip"'}
+
+def accepts_gzip(accept_encoding):
+    """True when Accept-Encoding allows gzip with q > 0 (directly or through "*")"""
+    qvalues = {}
+    for part in accept_encoding.lower().split(","):
+        coding, _, params = part.partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qvalues[coding.strip()] = q
+    for coding in ("gzip", "x-gzip", "*"):
+        if coding in qvalues:
+            return qvalues[coding] > 0
+    return False
 
-def find_header_row(file_bytes):
+@app.get("/", response_class=HTMLResponse)
+async def home(request: Request):
+    if accepts_gzip(request.headers.get("accept-encoding", "")):
+        body, headers = HOME_HTML_GZIP, HOME_GZIP_HEADERS
+    else:
+        body, headers = HOME_HTML_BYTES, HOME_HEADERS
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+    if body is HOME_HTML_GZIP:
+        headers = {**headers, "Content-Encoding": "gzip"}
+    return HTMLResponse(body, headers=headers)
+
+TRACKING_COLUMN_KEYWORDS = ['HAWB', 'TRACKING', 'GUIA', 'FEDEX']
+CLIENT_COLUMN_KEYWORDS = ['CLIENTE', 'CLIENT', 'NOMBRE']
+TRACKING_COLUMN_RE = re.compile('|'.join(map(re.escape, TRACKING_COLUMN_KEYWORDS)))
+CLIENT_COLUMN_RE = re.compile('|'.join(map(re.escape, CLIENT_COLUMN_KEYWORDS)))
+# Keywords que marcan la fila de header ('FEDEX TRACKING' ya queda cubierto por 'TRACKING')
+HEADER_ROW_RE = re.compile('HAWB|TRACKING|GUIA|NÚMERO DE GUÍA')
+
+
+def find_header_row(excel_file):
     """
     Detecta automáticamente la fila de encabezado en un archivo Excel.
     Busca la fila que contiene 'HAWB', 'TRACKING', o 'FEDEX' como indicador de header.
-    Retorna (header_row_index, dataframe) o (None, None) si no encuentra header.
+    Retorna el índice de la fila de header (0 si no encuentra keywords).
     """
-    # Leer sin header para inspeccionar todas las filas
-    df_raw = pd.read_excel(BytesIO(file_bytes), header=None, dtype=str, nrows=10)
-
-    header_keywords = ['HAWB', 'TRACKING', 'FEDEX TRACKING', 'GUIA', 'NÚMERO DE GUÍA']
+    # Leer sin header para inspeccionar las primeras filas
+    df_raw = excel_file.parse(header=None, dtype=str, nrows=10)
 
     for row_idx in range(min(5, len(df_raw))):  # Buscar en las primeras 5 filas
-        row_values = [str(v).upper().strip() for v in df_raw.iloc[row_idx] if pd.notna(v)]
-        for keyword in header_keywords:
-            if any(keyword in val for val in row_values):
-                # Encontramos el header en esta fila
-                df = pd.read_excel(BytesIO(file_bytes), header=row_idx, dtype=str)
-                return row_idx, df
+        # Una búsqueda con la regex precompilada por celda, en lugar de un loop por keyword
+        if any(HEADER_ROW_RE.search(str(v).upper()) for v in df_raw.iloc[row_idx] if pd.notna(v)):
+            # Encontramos el header en esta fila
+            return row_idx
 
     # Si no encontramos header con keywords, intentar la primera fila como header
-    df = pd.read_excel(BytesIO(file_bytes), dtype=str)
-    return 0, df
+    return 0
+
+
+def find_named_columns(columns):
+    """Busca las columnas de tracking y cliente por nombre. Retorna (tracking_col, client_col)."""
+    # Un solo paso vectorizado sobre los nombres en mayúsculas, en lugar de un loop por columna
+    columns = pd.Index(columns)
+    cols_upper = columns.astype(str).str.upper().str.strip()
+    tracking_mask = cols_upper.str.contains(TRACKING_COLUMN_RE)
+    client_mask = cols_upper.str.contains(CLIENT_COLUMN_RE)
+    tracking_col = columns[tracking_mask][0] if tracking_mask.any() else None
+    client_col = columns[client_mask][0] if client_mask.any() else None
+    return tracking_col, client_col
+
+
+def find_tracking_column_by_values(df):
+    """Busca la primera columna que contenga valores numéricos de 10+ dígitos"""
+    for col in df.columns:
+        sample_values = df[col].dropna().head(5)
+        numeric_count = sum(1 for v in sample_values if clean_tracking_number(v) is not None)
+        if numeric_count >= 2:  # Al menos 2 valores parecen tracking numbers
+            logger.info(f"Columna de tracking detectada automáticamente: '{col}'")
+            return col
+    return None
+
+
+def read_tracking_sheet(excel_source):
+    """
+    Lee del Excel solo lo necesario: detecta el header, ubica las columnas de tracking
+    y cliente por nombre y carga únicamente esas columnas (usecols). Si ninguna columna
+    tiene un nombre reconocible, carga la hoja completa para detectarla por sus valores.
+    excel_source es el archivo subido (file-like). calamine copia el stream completo a un
+    buffer propio para parsearlo, así que el pico de memoria incluye los bytes del archivo
+    (acotados por MAX_UPLOAD_BYTES).
+    Retorna (header_row, df, tracking_col, client_col); tracking_col es None si no se encontró.
+    """
+    # ExcelFile abre el workbook una sola vez para las tres lecturas;
+    # calamine (Rust) parsea xlsx/xls mucho más rápido que openpyxl
+    with pd.ExcelFile(excel_source, engine="calamine") as excel_file:
+        header_row = find_header_row(excel_file)
+        # Unas filas de datos además del header: columnas sin título al final también cuentan
+        columns = list(excel_file.parse(header=header_row, nrows=10).columns)
+        tracking_col, client_col = find_named_columns(columns)
+
+        # Fallback cliente: tercera columna
+        if client_col is None and len(columns) > 2:
+            client_col = columns[2]
+
+        if tracking_col is not None:
+            usecols = sorted({columns.index(col) for col in (tracking_col, client_col) if col is not None})
+            df = excel_file.parse(header=header_row, usecols=usecols, dtype=str)
+            # Mantener los nombres de la lectura completa (pandas renombra duplicados según las columnas leídas)
+            df.columns = [columns[i] for i in usecols]
+        else:
+            # Fallback: buscar columnas con números largos en la hoja completa
+            df = excel_file.parse(header=header_row, dtype=str)
+            tracking_col = find_tracking_column_by_values(df)
+            if client_col is None and len(df.columns) > 2:
+                client_col = df.columns[2]
+
+    return header_row, df, tracking_col, client_col
 
 
 def clean_tracking_number(raw_value):
@@ -978,73 +1315,114 @@ def clean_tracking_number(raw_value):
     return tracking
 
 
+def clean_tracking_series(raw_values):
+    """
+    Versión vectorizada de clean_tracking_number para una columna completa.
+    Retorna una Series con el tracking limpio, o <NA> donde no es válido.
+    """
+    tracking = (
+        raw_values.astype("string")
+        .str.strip()
+        .str.removesuffix(".0")
+        .str.replace(r"[ -]", "", regex=True)
+    )
+    # Numérico y al menos 10 dígitos (FedEx tracking estándar)
+    return tracking.where(tracking.str.fullmatch(r"\d{10,}").fillna(False))
+
+
+class UploadSizeLimit:
+    """
+    ASGI middleware refusing oversized /start-process uploads from their Content-Length,
+    before Starlette receives and spools the body. The server enforces that the body
+    matches the declared length, so requests without one are refused too (411).
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] == "/start-process":
+            content_length = dict(scope["headers"]).get(b"content-length", b"")
+            if not content_length.isdigit():
+                response = ORJSONResponse({"success": False, "error": "Falta el tamaño del archivo (Content-Length)"}, status_code=411)
+                return await response(scope, receive, send)
+            if int(content_length) > MAX_UPLOAD_BYTES + UPLOAD_OVERHEAD_BYTES:
+                response = ORJSONResponse({"success": False, "error": upload_too_large_message()}, status_code=413)
+                return await response(scope, receive, send)
+        await self.app(scope, receive, send)
+
+
+def upload_too_large_message():
+    return f"El archivo supera el máximo de {MAX_UPLOAD_BYTES // (1024 * 1024)} MB"
+
+
+app.add_middleware(UploadSizeLimit)
+
+
+def make_room_for_job():
+    """
+    Drop the oldest finished jobs (dicts keep insertion order) until a new one fits
+    under MAX_JOBS. Returns False when every slot is a job still processing.
+    """
+    finished = [job_id for job_id, job in jobs.items() if job["status"] != "processing"]
+    for job_id in finished:
+        if len(jobs) < MAX_JOBS:
+            break
+        del jobs[job_id]
+    return len(jobs) < MAX_JOBS
+
+
 @app.post("/start-process")
 async def start_process(file: UploadFile = File(...)):
     """Start processing and return job_id for progress tracking"""
     try:
-        contents = await file.read()
-
-        if not contents:
-            return JSONResponse({"success": False, "error": "El archivo está vacío"})
-
-        # Detectar header automáticamente
+        # Starlette ya dejó el upload en un SpooledTemporaryFile y se le pasa tal cual a pandas
+        # (sin una copia extra con await file.read()); calamine igual lo carga entero al parsear
+        if not file.size:
+            return ORJSONResponse({"success": False, "error": "El archivo está vacío"})
+        if file.size > MAX_UPLOAD_BYTES:
+            return ORJSONResponse({"success": False, "error": upload_too_large_message()}, status_code=413)
+
+        # Detectar header y columnas (en un thread: read_excel bloquea el event loop)
         try:
-            header_row, df = find_header_row(contents)
-            logger.info(f"Header detectado en fila {header_row}, {len(df)} filas, {len(df.columns)} columnas")
+            async with excel_semaphore:
+                header_row, df, tracking_col, client_col = await asyncio.to_thread(read_tracking_sheet, file.file)
+            logger.info(f"Header detectado en fila {header_row}, {len(df)} filas, {len(df.columns)} columnas leídas")
         except Exception as e:
             logger.error(f"Error leyendo Excel: {e}")
-            return JSONResponse({"success": False, "error": f"No se pudo leer el archivo Excel: {str(e)}"})
-
-        # Buscar columna de tracking por nombre
-        tracking_col = None
-        client_col = None
-        for col in df.columns:
-            col_upper = str(col).upper().strip()
-            if tracking_col is None and any(kw in col_upper for kw in ['HAWB', 'TRACKING', 'GUIA', 'FEDEX']):
-                tracking_col = col
-            if client_col is None and any(kw in col_upper for kw in ['CLIENTE', 'CLIENT', 'NOMBRE']):
-                client_col = col
-
-        # Fallback: si no encontró por nombre, intentar columna 14 o buscar columnas con números largos
-        if tracking_col is None:
-            # Buscar la primera columna que contenga valores numéricos de 10+ dígitos
-            for col in df.columns:
-                sample_values = df[col].dropna().head(5)
-                numeric_count = sum(1 for v in sample_values if clean_tracking_number(v) is not None)
-                if numeric_count >= 2:  # Al menos 2 valores parecen tracking numbers
-                    tracking_col = col
-                    logger.info(f"Columna de tracking detectada automáticamente: '{col}'")
-                    break
+            return ORJSONResponse({"success": False, "error": f"No se pudo leer el archivo Excel: {str(e)}"})
 
         if tracking_col is None:
-            return JSONResponse({"success": False, "error": "No se encontró la columna de tracking (HAWB). Verifica que tu archivo tenga una columna con números de guía FedEx."})
-
-        if client_col is None and len(df.columns) > 2:
-            client_col = df.columns[min(2, len(df.columns) - 1)]
+            return ORJSONResponse({"success": False, "error": "No se encontró la columna de tracking (HAWB). Verifica que tu archivo tenga una columna con números de guía FedEx."})
 
         logger.info(f"Columna tracking: '{tracking_col}', Columna cliente: '{client_col}'")
 
-        # Preparar lista de tracking
-        tracking_list = []
-        skipped_count = 0
-        for idx, row in df.iterrows():
-            tracking_number = clean_tracking_number(row[tracking_col])
-            client_name = str(row[client_col]).strip() if client_col and pd.notna(row[client_col]) else ""
-            if client_name.lower() == 'nan':
-                client_name = ""
-
-            if tracking_number:
-                tracking_list.append({"tracking": tracking_number, "client": client_name})
-            else:
-                skipped_count += 1
+        # Preparar lista de tracking (vectorizado sobre las columnas, sin iterrows)
+        tracking_numbers = clean_tracking_series(df[tracking_col])
+        valid = tracking_numbers.notna()
+        if client_col is not None:
+            client_names = df[client_col].astype("string").str.strip().fillna("")
+            client_names = client_names.mask(client_names.str.lower() == "nan", "")
+            client_names = client_names[valid].tolist()
+        else:
+            client_names = [""] * int(valid.sum())
+
+        tracking_list = [
+            {"tracking": tracking_number, "client": client_name}
+            for tracking_number, client_name in zip(tracking_numbers[valid].tolist(), client_names)
+        ]
+        skipped_count = len(df) - len(tracking_list)
 
         if not tracking_list:
-            return JSONResponse({"success": False, "error": f"No se encontraron números de tracking válidos en la columna '{tracking_col}'. Se revisaron {len(df)} filas."})
+            return ORJSONResponse({"success": False, "error": f"No se encontraron números de tracking válidos en la columna '{tracking_col}'. Se revisaron {len(df)} filas."})
 
         if skipped_count > 0:
             logger.info(f"Se omitieron {skipped_count} filas sin tracking válido")
 
-        # Crear job
+        # Crear job (si está lleno, liberar los terminados más antiguos)
+        if not make_room_for_job():
+            return ORJSONResponse({"success": False, "error": "El servidor está procesando demasiados archivos. Intenta de nuevo en unos minutos."}, status_code=503)
+
         job_id = str(uuid.uuid4())
         jobs[job_id] = {
             "status": "processing",
@@ -1052,23 +1430,26 @@ async def start_process(file: UploadFile = File(...)):
             "current": 0,
             "percent": 0,
             "tracking_list": tracking_list,
-            "results": [],
-            "error": None
+            "report": None,
+            "download_url": None,
+            "error": None,
+            # Replaced and set on every progress change (see notify_job_update)
+            "updated": asyncio.Event(),
         }
 
         # Iniciar procesamiento en background
         asyncio.create_task(process_tracking_job(job_id))
 
-        return JSONResponse({"job_id": job_id, "total": len(tracking_list)})
+        return ORJSONResponse({"job_id": job_id, "total": len(tracking_list)})
 
     except Exception as e:
         logger.error(f"Error starting process: {e}")
         import traceback
         traceback.print_exc()
-        return JSONResponse({"success": False, "error": f"Error procesando archivo: {str(e)}"})
+        return ORJSONResponse({"success": False, "error": f"Error procesando archivo: {str(e)}"})
 
 def parse_batch_response(batch_response, tracking_numbers):
-    """Parse a batch response from FedEx that contains multiple tracking results"""
+    """Parse a batch response from FedEx into tracking_number -> trackResults entry"""
     results_map = {}
 
     if not batch_response or "output" not in batch_response:
@@ -1080,33 +1461,158 @@ def parse_batch_response(batch_response, tracking_numbers):
         tn = ctr.get("trackingNumber", "")
         track_results = ctr.get("trackResults", [])
         if track_results:
-            # Build a response structure that parse_tracking_response expects
-            single_response = {
-                "output": {
-                    "completeTrackResults": [{
-                        "trackResults": track_results
-                    }]
-                }
-            }
-            results_map[tn] = single_response
+            results_map[tn] = track_results[0]
 
     return results_map
 
 
+def open_tracking_db(path):
+    """Open (or create) the SQLite tracking cache; returns None when disabled or unusable"""
+    if not path:
+        return None
+    db = None
+    try:
+        # Other workers share the file: wait a few seconds on their locks instead of failing
+        db = sqlite3.connect(path, timeout=5.0, check_same_thread=False)
+        # WAL lets readers in other workers keep going while one worker writes
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS tracking_cache ("
+            "tracking_number TEXT PRIMARY KEY, expires_at REAL NOT NULL, track_data BLOB NOT NULL)"
+        )
+        db.execute("CREATE INDEX IF NOT EXISTS tracking_cache_expires_at ON tracking_cache (expires_at)")
+        db.execute("DELETE FROM tracking_cache WHERE expires_at <= ?", (time.time(),))
+        db.commit()
+    except sqlite3.Error as e:
+        logger.warning("Tracking cache DB %s unavailable, caching in memory only: %s", path, e)
+        if db is not None:
+            db.close()
+        return None
+    return db
+
+
+def read_tracking_db(db, tracking_numbers, now):
+    """Unexpired (tracking_number, expires_at, track_data) rows; runs in a worker thread"""
+    placeholders = ",".join("?" * len(tracking_numbers))
+    with tracking_db_lock:
+        return db.execute(
+            f"SELECT tracking_number, expires_at, track_data FROM tracking_cache "
+            f"WHERE tracking_number IN ({placeholders}) AND expires_at > ?",
+            (*tracking_numbers, now),
+        ).fetchall()
+
+
+def write_tracking_db(db, rows, now):
+    """Store fresh results and prune expired ones in one transaction; runs in a worker thread"""
+    with tracking_db_lock, db:
+        db.executemany("INSERT OR REPLACE INTO tracking_cache VALUES (?, ?, ?)", rows)
+        db.execute("DELETE FROM tracking_cache WHERE expires_at <= ?", (now,))
+
+
+def remember_tracking(tracking_number, expires_at, track_data):
+    """Put one result in the in-memory cache, keeping it under TRACKING_CACHE_MAX_ENTRIES"""
+    # Re-inserting moves the key to the end, so dict order stays oldest-write first
+    tracking_cache.pop(tracking_number, None)
+    tracking_cache[tracking_number] = (expires_at, track_data)
+    if len(tracking_cache) <= TRACKING_CACHE_MAX_ENTRIES:
+        return
+    now = time.time()
+    for tn in [tn for tn, entry in tracking_cache.items() if entry[0] <= now]:
+        del tracking_cache[tn]
+    # Then trim to three quarters of the cap, oldest writes first, so sweeps stay rare
+    overflow = len(tracking_cache) - TRACKING_CACHE_MAX_ENTRIES * 3 // 4
+    if overflow > 0:
+        for tn in list(itertools.islice(tracking_cache, overflow)):
+            del tracking_cache[tn]
+
+
+async def get_cached_responses(tracking_numbers):
+    """
+    Return {tracking_number: trackResults entry} for cached, unexpired results.
+    Checks memory first, then the SQLite cache (which survives restarts) in one query.
+    """
+    now = time.time()
+    found = {}
+    missing = []
+    for tn in tracking_numbers:
+        entry = tracking_cache.get(tn)
+        if entry is not None and now < entry[0]:
+            found[tn] = entry[1]
+        else:
+            tracking_cache.pop(tn, None)
+            missing.append(tn)
+
+    db = app.state.tracking_db
+    if missing and db is not None:
+        try:
+            rows = await asyncio.to_thread(read_tracking_db, db, missing, now)
+        except sqlite3.Error as e:
+            # Only a cache: a locked or broken DB just means fetching from FedEx
+            logger.warning("Tracking cache DB read failed, using memory only: %s", e)
+            rows = ()
+        for tn, expires_at, track_data in rows:
+            found[tn] = orjson.loads(track_data)
+            remember_tracking(tn, expires_at, found[tn])
+
+    return found
+
+
+async def cache_responses(results_map):
+    """Cache tracking results; terminal statuses (delivered, cancelled, returned) live longer"""
+    now = time.time()
+    rows = []
+    for tn, track_data in results_map.items():
+        # FedEx reports per-tracking errors inside a 200 response; don't cache those
+        if track_data.get("error"):
+            continue
+        status_code = track_data.get("latestStatusDetail", {}).get("code", "")
+        ttl = TRACKING_CACHE_TTL_FINAL if status_code.upper() in FINAL_STATUS_CODES else TRACKING_CACHE_TTL
+        remember_tracking(tn, now + ttl, track_data)
+        rows.append((tn, now + ttl, orjson.dumps(track_data)))
+
+    db = app.state.tracking_db
+    if rows and db is not None:
+        try:
+            await asyncio.to_thread(write_tracking_db, db, rows, now)
+        except sqlite3.Error as e:
+            logger.warning("Tracking cache DB write failed, results cached in memory only: %s", e)
+
+
+async def fetch_tracking_batch(client, tracking_numbers):
+    """
+    Resolve one batch of tracking numbers, serving cached ones and fetching the rest
+    in a single FedEx call. Returns (tracking_numbers, results_map, made_api_call, fetch_failed);
+    fetch_failed means FedEx gave no answer (errors, retries exhausted, circuit open).
+    """
+    results_map = await get_cached_responses(tracking_numbers)
+    to_fetch = [tn for tn in tracking_numbers if tn not in results_map]
+
+    if to_fetch:
+        async with fedex_semaphore:
+            batch_response = await client.track_shipments_batch(to_fetch)
+
+        if batch_response:
+            fetched = parse_batch_response(batch_response, to_fetch)
+            await cache_responses(fetched)
+            results_map.update(fetched)
+
+    return tracking_numbers, results_map, bool(to_fetch), bool(to_fetch) and not batch_response
+
+
 async def process_tracking_job(job_id: str):
     """
     Background task to process tracking numbers using batch API calls.
     FedEx allows up to 30 tracking numbers per request.
     This turns 3000 individual requests into just 100 batch requests.
     """
-    client = FedExClient()
+    client = app.state.fedex
     try:
         job = jobs[job_id]
         tracking_list = job["tracking_list"]
         total = len(tracking_list)
 
-        # Authenticate once before starting
-        if not await client.authenticate():
+        # Authenticate before starting unless the shared token is still valid
+        if not await client.ensure_token():
             job["status"] = "error"
             job["error"] = "No se pudo autenticar con FedEx API"
             return
@@ -1114,42 +1620,70 @@ async def process_tracking_job(job_id: str):
         # FedEx recommends max 30 tracking numbers per request
         BATCH_SIZE = 30
         processed = 0
-
-        for batch_start in range(0, total, BATCH_SIZE):
-            batch_end = min(batch_start + BATCH_SIZE, total)
-            batch = tracking_list[batch_start:batch_end]
-
-            # Extract tracking numbers for this batch
-            batch_tracking_numbers = [item["tracking"] for item in batch]
-
-            # Single API call for up to 30 tracking numbers
-            batch_response = await client.track_shipments_batch(batch_tracking_numbers)
-
-            # Parse batch response
-            if batch_response:
-                results_map = parse_batch_response(batch_response, batch_tracking_numbers)
-            else:
-                results_map = {}
-
-            # Match results back to items with client names
-            for item in batch:
-                tn = item["tracking"]
-                single_response = results_map.get(tn, None)
-                parsed = parse_tracking_response(single_response, tn)
-                parsed["client_name"] = item["client"]
-                job["results"].append(parsed)
-
-                processed += 1
+        api_calls = 0
+        # Rows left without FedEx data because their batch call failed
+        failed_rows = 0
+
+        # Track each distinct number once; duplicate rows reuse the parsed result
+        row_counts = Counter(item["tracking"] for item in tracking_list)
+        unique_numbers = list(row_counts)
+        unique_total = len(unique_numbers)
+        row_by_tracking = {}
+        # One reference time for every row's day counts (and one clock read per job)
+        today = datetime.now()
+
+        # Dispatch all batches concurrently; fedex_semaphore bounds how many are in flight
+        # and the 429 backoff in track_shipments_batch handles rate limiting
+        batches = [unique_numbers[i:i + BATCH_SIZE] for i in range(0, unique_total, BATCH_SIZE)]
+        tasks = [asyncio.create_task(fetch_tracking_batch(client, batch)) for batch in batches]
+        try:
+            for next_batch in asyncio.as_completed(tasks):
+                batch_tracking_numbers, results_map, made_api_call, fetch_failed = await next_batch
+                api_calls += made_api_call
+
+                for tn in batch_tracking_numbers:
+                    if fetch_failed and tn not in results_map:
+                        failed_rows += row_counts[tn]
+                    parsed = parse_tracking_response(results_map.get(tn), tn, today)
+                    row_by_tracking[tn] = tuple(parsed[key] for key in TRACKING_RESULT_KEYS)
+                    # Progress counts spreadsheet rows, including duplicates
+                    processed += row_counts[tn]
+
+                # Publish progress once per batch; integer math avoids float artifacts (29/100*100 -> 28)
                 job["current"] = processed
-                job["percent"] = int((processed / total) * 100)
+                job["percent"] = processed * 100 // total
+                notify_job_update(job)
+        finally:
+            for task in tasks:
+                task.cancel()
 
-            # Small pause between batch requests to respect rate limits
-            # FedEx allows 1400 per 10 seconds, but we're conservative
-            if batch_end < total:
-                await asyncio.sleep(0.5)
+        if failed_rows == total:
+            job["status"] = "error"
+            job["error"] = "FedEx no está respondiendo. Intenta de nuevo en unos minutos."
+            logger.error("Job %s failed: no FedEx data for any of %d tracking numbers", job_id, total)
+            return
+        if failed_rows:
+            # The report still goes out, but the user must know those rows carry no FedEx data
+            job["warning"] = f"FedEx no respondió para {failed_rows} de {total} guías; aparecen como Unknown en el reporte."
+            logger.warning("Job %s: no FedEx data for %d of %d tracking numbers", job_id, failed_rows, total)
+
+        # Match results back to rows (original order) as report-ordered tuples,
+        # client name first (see OUTPUT_COLUMNS)
+        rows = [
+            (item["client"], *row_by_tracking[item["tracking"]])
+            for item in tracking_list
+        ]
+        # The input list is no longer needed once the rows are built
+        del job["tracking_list"]
+
+        # Build the report now so /download only has to send bytes; the finished job
+        # then holds the (zip-compressed) xlsx instead of every row tuple
+        async with excel_semaphore:
+            job["report"] = await asyncio.to_thread(build_result_excel, rows)
+        job["download_url"] = f"/download/{job_id}"
 
         job["status"] = "completed"
-        logger.info(f"Job {job_id} completed: {total} tracking numbers processed in {(total + BATCH_SIZE - 1) // BATCH_SIZE} API calls")
+        logger.info("Job %s completed: %d tracking numbers (%d unique) processed in %d API calls", job_id, total, unique_total, api_calls)
 
     except Exception as e:
         logger.error(f"Error in job {job_id}: {e}")
@@ -1158,53 +1692,131 @@ async def process_tracking_job(job_id: str):
         jobs[job_id]["status"] = "error"
         jobs[job_id]["error"] = str(e)
     finally:
-        await client.close()
+        # Final status (completed or error) reaches any open progress stream right away
+        if job_id in jobs:
+            notify_job_update(jobs[job_id])
+        # /download pops completed jobs; this bounds memory for the ones nobody collects
+        asyncio.get_running_loop().call_later(JOB_TTL, jobs.pop, job_id, None)
 
-@app.get("/progress/{job_id}")
-async def get_progress(job_id: str):
-    """Get current progress of a job"""
-    if job_id not in jobs:
-        return JSONResponse({"error": "Job not found"}, status_code=404)
+# Idle progress streams send an SSE comment this often so proxies keep the connection open
+PROGRESS_STREAM_KEEPALIVE = 15.0
 
-    job = jobs[job_id]
-    return JSONResponse({
+def notify_job_update(job):
+    """
+    Wake every progress stream waiting on this job. Each stream waits on the Event
+    that was current when it last read the job, so swapping in a fresh Event and
+    setting the old one is a broadcast with no missed updates.
+    """
+    updated, job["updated"] = job["updated"], asyncio.Event()
+    updated.set()
+
+def progress_payload(job):
+    return {
         "status": job["status"],
         "total": job["total"],
         "current": job["current"],
         "percent": job["percent"],
-        "error": job.get("error")
-    })
+        "error": job.get("error"),
+        "warning": job.get("warning"),
+        "download_url": job.get("download_url"),
+    }
 
-@app.get("/result/{job_id}")
-async def get_result(job_id: str):
-    """Get the result Excel file for a completed job"""
+@app.get("/progress/{job_id}")
+async def get_progress(job_id: str, request: Request):
+    """Get current progress of a job; answers 304 while it has not moved since the client's ETag"""
     if job_id not in jobs:
-        return JSONResponse({"success": False, "error": "Job not found"})
+        return ORJSONResponse({"error": "Job not found"}, status_code=404)
 
     job = jobs[job_id]
-    if job["status"] != "completed":
-        return JSONResponse({"success": False, "error": "Job not completed yet"})
+    etag = f'W/"{job["status"]}-{job["current"]}"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    return ORJSONResponse(progress_payload(job), headers={"ETag": etag})
+
+@app.get("/progress-stream/{job_id}")
+async def stream_progress(job_id: str):
+    """Server-sent events with the job's progress, pushed as soon as it changes; ends when the job finishes"""
+    if job_id not in jobs:
+        return ORJSONResponse({"error": "Job not found"}, status_code=404)
+
+    async def events():
+        last_payload = None
+        while True:
+            job = jobs.get(job_id)
+            if job is None:
+                yield b"data: " + orjson.dumps({"status": "error", "error": "Job not found"}) + b"\n\n"
+                return
+            updated = job["updated"]
+            payload = progress_payload(job)
+            if payload != last_payload:
+                yield b"data: " + orjson.dumps(payload) + b"\n\n"
+                last_payload = payload
+            if payload["status"] != "processing":
+                return
+            # Sleep until process_tracking_job reports a change
+            try:
+                await asyncio.wait_for(updated.wait(), PROGRESS_STREAM_KEEPALIVE)
+            except asyncio.TimeoutError:
+                yield b": keepalive\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        # Don't let proxies buffer the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+def build_result_excel(results):
+    """Build the SonIA report workbook from rows in OUTPUT_COLUMNS order and return it as xlsx bytes"""
+    output = BytesIO()
+    # constant_memory streams each row to a temp file as soon as it's complete,
+    # so rows must be written strictly in order (header first, then data rows)
+    workbook = xlsxwriter.Workbook(output, {
+        "constant_memory": True,
+        "strings_to_formulas": False,
+        "strings_to_urls": False,
+    })
+    worksheet = workbook.add_worksheet()
+    header_format = workbook.add_format({"bold": True, "border": 1, "align": "center", "valign": "top"})
 
-    try:
-        results = job["results"]
-        output_df = pd.DataFrame(results)
-        output_df = output_df[["client_name", "tracking_number", "sonia_status", "fedex_status", "label_creation_date", "ship_date", "days_after_shipment", "working_days_after_shipment", "days_after_label_creation", "destination_location", "history_summary", "sonia_recommendation"]]
-        output_df.columns = ["Nombre Cliente", "FEDEX Tracking", "SonIA status", "FedEx status", "Label Creation Date", "Shipping Date", "Days After Shipment", "Working Days After Shipment", "Days After Label Creation", "Destination City/State/Country", "Historial", "SonIA Recomendacion"]
+    worksheet.write_row(0, 0, [header for _, header in OUTPUT_COLUMNS], header_format)
+    for row_idx, row in enumerate(results, start=1):
+        worksheet.write_row(row_idx, 0, row)
 
-        output = BytesIO()
-        output_df.to_excel(output, index=False)
-        output.seek(0)
-        encoded = base64.b64encode(output.read()).decode()
+    workbook.close()
+    return output.getvalue()
 
-        # Clean up job after getting result
-        del jobs[job_id]
+XLSX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+@app.get("/download/{job_id}")
+async def download_result(job_id: str):
+    """Download the result Excel file for a completed job as a binary attachment"""
+    if job_id not in jobs:
+        return ORJSONResponse({"success": False, "error": "Job not found"}, status_code=404)
 
-        return JSONResponse({"success": True, "file": encoded})
+    job = jobs[job_id]
+    if job["status"] != "completed":
+        return ORJSONResponse({"success": False, "error": "Job not completed yet"}, status_code=409)
 
-    except Exception as e:
-        logger.error(f"Error generating result: {e}")
-        return JSONResponse({"success": False, "error": str(e)})
+    # Clean up job after getting result; the report was built when the job finished
+    jobs.pop(job_id, None)
+
+    return Response(
+        content=job["report"],
+        media_type=XLSX_MEDIA_TYPE,
+        headers={"Content-Disposition": 'attachment; filename="SonIA_Tracking_Results.xlsx"'},
+    )
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", 8080)))
+    # uvloop + httptools are the C event loop / HTTP parser shipped with uvicorn[standard].
+    # Job progress lives in the in-process `jobs` dict, so running more than one
+    # worker needs sticky routing; WEB_CONCURRENCY therefore defaults to 1.
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", 8080)),
+        workers=int(os.getenv("WEB_CONCURRENCY", 1)),
+        loop="uvloop",
+        http="httptools",
+    )